@@ -5,29 +5,181 @@ author_url: https://github.com/ezavesky
 git_url: https://github.com/open-webui/pipelines/
 description: Access FlowiseAI endpoints via chat integration
 required_open_webui_version: 0.4.3
-requirements: requests,flowise>=1.0.4
+requirements: requests,httpx[http2],orjson,msgspec
 version: 0.4.3.8
 licence: MIT
 """
 
-from typing import List, Union, Generator, Iterator, Dict, Optional
+from typing import Any, List, Union, Generator, Iterator, Dict, Optional
 from pydantic import BaseModel, Field
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import httpx
 import os
 import json
 from datetime import datetime
 import time
-from flowise import Flowise, PredictionData
-from logging import getLogger
+import threading
+from contextlib import contextmanager
+from functools import reduce
+from logging import getLogger, DEBUG
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
 
 logger = getLogger(__name__)
-logger.setLevel("DEBUG")
+
+# How long fetched chatflow metadata is reused before asking Flowise again (seconds)
+FLOW_DETAILS_TTL = 300.0
+
+# (connect, read) timeouts in seconds. Predictions get a long read timeout since a non-streaming answer's first byte only
+# arrives once the whole flow has run; connect stays tight so an unreachable host fails fast.
+REQUEST_TIMEOUT = (3.05, 30)
+PREDICTION_TIMEOUT = (3.05, 120)
+
+# Streamed tokens are yielded in batches of up to this many, or whenever this long has passed since the last batch (seconds)
+TOKEN_BATCH_SIZE = 8
+TOKEN_BATCH_INTERVAL = 0.05
+
+# How long a call waits for a MAX_CONCURRENCY slot before giving up with UPSTREAM_BUSY_MESSAGE (seconds). Bounded because
+# waiters occupy the server's shared worker threads, which slot holders also need to advance their streams.
+UPSTREAM_SLOT_TIMEOUT = 5.0
+UPSTREAM_BUSY_MESSAGE = "⏳ FlowiseAI is busy with other requests, please try again shortly."
+
+# How long a call waits in the rate limiter queue before giving up with RATE_LIMITED_MESSAGE (seconds). Bounded because
+# waiters occupy the server's shared worker threads, which every other pipeline needs as well.
+RATE_LIMIT_TIMEOUT = 10.0
+RATE_LIMITED_MESSAGE = "⏳ Rate limit reached, please try again shortly."
+
+# orjson is several times faster than the stdlib for both directions; fall back to json if it is missing.
+# orjson.JSONDecodeError subclasses json.JSONDecodeError, so existing except clauses keep working.
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj) -> str:
+        return orjson.dumps(obj).decode()
+
+    def _dumps_pretty(obj) -> str:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode()
+else:
+    _loads = json.loads
+    # Reused encoders skip json.dumps' per-call JSONEncoder construction and match orjson's compact, non-ASCII output
+    _dumps = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+    _dumps_pretty = json.JSONEncoder(ensure_ascii=False, indent=2).encode
+
+
+# Fixed Open WebUI status updates, built once and shared; the server only serializes what pipe() yields.
+# Chunks stay str: the server decodes any bytes back to str before wrapping them, so pre-encoding would only add work.
+_STATUS_THINKING = {
+    "event": {
+        "type": "status",
+        "data": {
+            "description": "Thinking...\n",
+            "done": False
+        }
+    }
+}
+_STATUS_TOOL_CALLING = {
+    "event": {
+        "type": "status",
+        "data": {
+            "description": "Tool calling...\n",
+            "done": False
+        }
+    }
+}
+
+
+# Typed decoding of the fixed {event, data, error} shape of stream chunks; msgspec builds the
+# top-level record in C instead of a dict. Chunks that do not fit the shape use the generic decoder.
+_NO_ERROR = msgspec.UNSET if msgspec is not None else object()
+
+if msgspec is not None:
+    class _StreamEvent(msgspec.Struct, frozen=True):
+        event: Optional[str] = None
+        data: Any = None
+        error: Any = msgspec.UNSET
+
+    _decode_event = msgspec.json.Decoder(_StreamEvent).decode
+else:
+    _decode_event = None
+
+
+def _parse_chunk(chunk) -> tuple:
+    """Splits a stream chunk into (event, data, error), error being _NO_ERROR if absent. Raises json.JSONDecodeError on invalid JSON."""
+    if isinstance(chunk, (str, bytes)):
+        if _decode_event is not None:
+            try:
+                evt = _decode_event(chunk)
+                return evt.event, evt.data, evt.error
+            except msgspec.DecodeError:
+                pass
+        chunk = _loads(chunk)
+    return chunk.get("event"), chunk.get("data"), chunk.get("error", _NO_ERROR)
+
+
+def _looks_jsonish(s: str) -> bool:
+    """True if `s`, ignoring surrounding whitespace, is bracketed like a JSON object or array. Never copies the string."""
+    i, n = 0, len(s)
+    while i < n and s[i] <= ' ':
+        i += 1
+    if i == n:
+        return False
+    j = n - 1
+    while j > i and s[j] <= ' ':
+        j -= 1
+    a, b = s[i], s[j]
+    return (a == '{' and b == '}') or (a == '[' and b == ']')
+
+
+class _UpstreamBusy(Exception):
+    """Raised when no MAX_CONCURRENCY slot frees up within UPSTREAM_SLOT_TIMEOUT."""
+
+
+class _StreamState:
+    """Per-call state of one stream_retrieve run, handed to the event handlers."""
+    __slots__ = ("start_stamp", "end_stamp", "token_buf", "last_flush",
+                 "show_reasoning", "show_tools", "show_tools_input", "show_tools_output")
+
+    def __init__(self, start_stamp: str, flags: tuple):
+        self.start_stamp = start_stamp
+        self.show_reasoning, self.show_tools, self.show_tools_input, self.show_tools_output = flags
+        self.end_stamp = None
+        self.token_buf = []
+        self.last_flush = time.monotonic()
+
+    def flush_tokens(self) -> str:
+        # Cleared even if the join fails, so one bad entry cannot wedge every later flush
+        try:
+            return "".join(self.token_buf)
+        finally:
+            self.token_buf.clear()
+            self.last_flush = time.monotonic()
+
+
+def _stream_message(message: str) -> Generator:
+    """Wraps a single message for streaming callers; as a Generator the server also closes the stream with [DONE]."""
+    yield message
+
+
+def _format_other_event(event: str, data) -> str:
+    return f"[Other Event: {event}] {_dumps(data)}\n"
+
 
 class Pipeline:
     class Valves(BaseModel):
         FLOWISE_API_KEY: str = Field(default="changeme", description="FlowiseAI API key")
         FLOWISE_BASE_URL: str = Field(default="changeme", description="FlowiseAI base URL")
         RATE_LIMIT: int = Field(default=15, description="Rate limit for the pipeline (ops/minute)")
+        MAX_CONCURRENCY: int = Field(default=10, description="Maximum number of FlowiseAI requests in flight at once")
         FLOW_ENABLED: Optional[bool] = Field(default=False, description="Flow Enabled")
         FLOW_ID: Optional[str] = Field(default=None, description="Flow ID")
         FLOW_NAME: Optional[str] = Field(default=None, description="Flow Name")
@@ -45,85 +197,260 @@ class Pipeline:
         DISPLAY_END_EVENT: Optional[bool] = Field(default=True, description="Display end event data")
         DISPLAY_OTHER_EVENTS: Optional[bool] = Field(default=True, description="Display other unhandled events")
 
+    # Fields of a static prediction response that carry the answer, in order of preference
+    _STATIC_KEYS = ("text", "answer", "response", "result")
+
     def __init__(self):
         self.name = "FlowiseAI Pipeline"
         logger.info(f"Initializing {self.name}")
-        self.valves = self.Valves(
-            **{k: os.getenv(k, v.default) for k, v in self.Valves.model_fields.items()}
-        )
+        # Already validated at import, so skip re-running validation for every instance
+        self.valves = self.Valves.model_construct(**_ENV_VALVES)
         self.flow_id = None
         self.flow_name = None
         self.api_flow_name = None
+
+        # Shared HTTP session so keep-alive connections to the Flowise host are pooled across calls
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=20,
+            max_retries=Retry(
+                total=3,
+                connect=2,
+                read=1,
+                backoff_factor=0.25,
+                status_forcelist=(502, 503, 504),
+                allowed_methods=frozenset(["GET", "POST"]),
+                raise_on_status=False
+            )
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        self._session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        # Async HTTP/2 counterpart used from the server's event-loop hooks; bound to a running loop, so created lazily
+        self._aclient: Optional[httpx.AsyncClient] = None
+
+        # Token bucket state for rate limiting, guarded since pipe() runs on worker threads.
+        # Waiters queue up by ticket on the condition and are admitted in arrival order.
+        self._rate_cond = threading.Condition()
+        self._rate_next_ticket = 0
+        self._rate_serving = 0
+        # Tickets whose callers gave up before reaching the head of the queue
+        self._rate_abandoned = set()
+        # RATE_LIMIT the bucket was last sized for; None until the valves are first applied
+        self._rate_limit: Optional[int] = None
+        self._capacity = 1.0
+        self._tokens = 1.0
+        self._refill_rate = 1.0 / 60.0
+        self._last_refill = time.monotonic()
+        # Caps in-flight prediction requests; swapped for a new one when MAX_CONCURRENCY changes
+        self._upstream_slots: Optional[threading.BoundedSemaphore] = None
+        self._upstream_limit: Optional[int] = None
+
+        # flow_id -> (fetched_at, details); dropped whenever the connection valves it was fetched with change
+        self._flow_details_cache: Dict[str, tuple] = {}
+        self._flow_details_source: Optional[tuple] = None
         self.update_flow_details()
 
+    def _cached_flow_details(self, flow_id: str) -> Optional[dict]:
+        cached = self._flow_details_cache.get(flow_id)
+        if cached and time.monotonic() - cached[0] < FLOW_DETAILS_TTL:
+            logger.debug(f"Using cached flow details for Flow ID: {flow_id}")
+            return cached[1]
+        return None
+
     def get_flow_details(self, flow_id: str) -> Optional[dict]:
+        flow_details = self._cached_flow_details(flow_id)
+        if flow_details is not None:
+            return flow_details
+
         logger.info(f"Fetching flow details for Flow ID: {flow_id}")
         try:
-            api_url = f"{self.valves.FLOWISE_BASE_URL.rstrip('/')}/api/v1/chatflows/{flow_id}"
-            headers = {"Authorization": f"Bearer {self.valves.FLOWISE_API_KEY}"}
-            response = requests.get(api_url, headers=headers)
+            api_url = self._chatflow_url + flow_id
+            response = self._session.get(api_url, timeout=REQUEST_TIMEOUT)
             if response.status_code == 200:
-                return response.json()
+                flow_details = _loads(response.content)
+                self._flow_details_cache[flow_id] = (time.monotonic(), flow_details)
+                return flow_details
             else:
                 logger.error(f"Failed to fetch flow details. Status code: {response.status_code}")
         except Exception as e:
             logger.error(f"Exception fetching flow details: {str(e)}")
         return None
 
-    def update_flow_details(self):
+    async def _aget_flow_details(self, flow_id: str) -> Optional[dict]:
+        """Non-blocking variant of get_flow_details for use on the server's event loop."""
+        flow_details = self._cached_flow_details(flow_id)
+        if flow_details is not None:
+            return flow_details
+
+        logger.info(f"Fetching flow details for Flow ID: {flow_id}")
+        try:
+            if self._aclient is None:
+                self._aclient = httpx.AsyncClient(
+                    http2=True,
+                    limits=httpx.Limits(max_connections=100, max_keepalive_connections=20),
+                    timeout=httpx.Timeout(REQUEST_TIMEOUT[1], connect=REQUEST_TIMEOUT[0])
+                )
+            # Absolute URL and per-request headers, so valve changes apply without rebuilding the client
+            response = await self._aclient.get(self._chatflow_url + flow_id, headers=self._auth_headers)
+            if response.status_code == 200:
+                flow_details = _loads(response.content)
+                self._flow_details_cache[flow_id] = (time.monotonic(), flow_details)
+                return flow_details
+            logger.error(f"Failed to fetch flow details. Status code: {response.status_code}")
+        except Exception as e:
+            logger.error(f"Exception fetching flow details: {str(e)}")
+        return None
+
+    def _begin_flow_update(self) -> bool:
+        """Re-applies valve-derived state and clears the flow fields. Returns True if a flow is fully configured."""
         logger.info("Updating flow configuration...")
+        # Valves may have changed (valves.json load, UI update), so refresh the session credentials first
+        self._api_key = self.valves.FLOWISE_API_KEY
+        self._auth_headers = {"Authorization": f"Bearer {self._api_key}"}
+        self._session.headers.update(self._auth_headers)
+        self._apply_rate_limit()
+        # Calls already in flight release the semaphore they acquired, so replacing it is safe mid-request
+        limit = max(1, self.valves.MAX_CONCURRENCY)
+        if limit != self._upstream_limit:
+            self._upstream_slots = threading.BoundedSemaphore(limit)
+            self._upstream_limit = limit
+        # Canonical base URL and endpoint prefixes, built once per valve change rather than on every request
+        self._base_url = self.valves.FLOWISE_BASE_URL.rstrip('/')
+        self._chatflow_url = self._base_url + "/api/v1/chatflows/"
+        self._prediction_url = self._base_url + "/api/v1/prediction/"
+        # Per-request gates read by pipe, snapshotted as plain attributes alongside the event handler table
+        self._has_connection = bool(self._api_key and self.valves.FLOWISE_BASE_URL)
+        self._flow_enabled = self.valves.FLOW_ENABLED
+        # Checked here rather than in on_valves_updated, since the valves.json load at boot bypasses that hook
+        source = (self.valves.FLOWISE_BASE_URL, self.valves.FLOWISE_API_KEY)
+        if source != self._flow_details_source:
+            self._flow_details_cache.clear()
+            self._flow_details_source = source
         self.flow_id = None
         self.flow_name = None
         self.api_flow_name = None
+        self._build_event_handlers()
 
         if self.valves.FLOW_ENABLED and self.valves.FLOW_ID and self.valves.FLOW_NAME:
-            flow_details = self.get_flow_details(self.valves.FLOW_ID)
-            self.flow_id = self.valves.FLOW_ID
-            self.flow_name = self.valves.FLOW_NAME.lower()
-            self.api_flow_name = flow_details.get('name', 'Unknown') if flow_details else 'Unknown'
-            logger.info(f"Flow configured: {self.flow_name} (API Name: {self.api_flow_name}, ID: {self.flow_id})")
-        else:
-            logger.warning("FlowiseAI flow is not fully configured or not enabled.")
+            return True
+        logger.warning("FlowiseAI flow is not fully configured or not enabled.")
+        return False
+
+    def _configure_flow(self, flow_details: Optional[dict]):
+        self.flow_id = self.valves.FLOW_ID
+        self.flow_name = self.valves.FLOW_NAME.lower()
+        self.api_flow_name = flow_details.get('name', 'Unknown') if flow_details else 'Unknown'
+        logger.info(f"Flow configured: {self.flow_name} (API Name: {self.api_flow_name}, ID: {self.flow_id})")
+
+    def update_flow_details(self):
+        if self._begin_flow_update():
+            self._configure_flow(self.get_flow_details(self.valves.FLOW_ID))
+
+    async def aupdate_flow_details(self):
+        """Same as update_flow_details, but fetches without blocking the event loop."""
+        if self._begin_flow_update():
+            self._configure_flow(await self._aget_flow_details(self.valves.FLOW_ID))
 
     async def on_startup(self):
         logger.info(f"Starting up {self.name}...")
-        self.update_flow_details()
+        # Re-applied because the server swaps in valves.json values after __init__; unchanged valves hit the cache
+        await self.aupdate_flow_details()
 
     async def on_shutdown(self):
         logger.info(f"Shutting down {self.name}...")
+        self._session.close()
+        if self._aclient is not None:
+            await self._aclient.aclose()
+            self._aclient = None
 
     async def on_valves_updated(self) -> None:
         logger.info("Valves updated. Refreshing flow details...")
-        self.update_flow_details()
+        await self.aupdate_flow_details()
 
-    def rate_check(self, dt_start: datetime) -> bool:
-        dt_end = datetime.now()
-        time_diff = (dt_end - dt_start).total_seconds()
-        time_buffer = (1 / self.valves.RATE_LIMIT)
-        if time_diff < time_buffer:
-            sleep_time = time_buffer - time_diff
-            logger.info(f"Rate limit active. Sleeping for {sleep_time:.2f} seconds")
-            time.sleep(sleep_time)
-            return True
-        return False
+    def _apply_rate_limit(self):
+        """Sizes the token bucket for RATE_LIMIT calls per minute. Does nothing unless the limit changed, so valve saves cannot refill it."""
+        limit = max(1, self.valves.RATE_LIMIT)
+        with self._rate_cond:
+            if limit == self._rate_limit:
+                return
+            now = time.monotonic()
+            if self._rate_limit is None:
+                # The first application starts with a full burst
+                self._tokens = float(limit)
+            else:
+                # Settle what accrued at the old rate, then clamp to the new size instead of refilling
+                accrued = min(self._capacity, self._tokens + (now - self._last_refill) * self._refill_rate)
+                self._tokens = min(float(limit), accrued)
+            self._rate_limit = limit
+            self._capacity = float(limit)
+            self._refill_rate = self._capacity / 60.0
+            self._last_refill = now
+            # Wake any waiters so they re-evaluate against the new limit instead of finishing the old wait
+            self._rate_cond.notify_all()
+
+    def _advance_rate_queue(self):
+        """Moves the head of the FIFO queue past the current ticket and any abandoned ones behind it. Caller holds _rate_cond."""
+        self._rate_serving += 1
+        while self._rate_serving in self._rate_abandoned:
+            self._rate_abandoned.remove(self._rate_serving)
+            self._rate_serving += 1
+        self._rate_cond.notify_all()
+
+    def _acquire(self, cost: float = 1.0) -> bool:
+        """Takes `cost` tokens from the bucket, waiting in FIFO order only when it is empty. Returns False if none came within RATE_LIMIT_TIMEOUT."""
+        deadline = time.monotonic() + RATE_LIMIT_TIMEOUT
+        delayed = False
+        with self._rate_cond:
+            ticket = self._rate_next_ticket
+            self._rate_next_ticket += 1
+            while True:
+                now = time.monotonic()
+                timeout = deadline - now
+                if ticket == self._rate_serving:
+                    # Tokens are kept fractional so tiny deltas between calls still accrue instead of being dropped
+                    self._tokens = min(self._capacity, self._tokens + (now - self._last_refill) * self._refill_rate)
+                    self._last_refill = now
+                    if self._tokens >= cost:
+                        self._tokens -= cost
+                        self._advance_rate_queue()
+                        return True
+                    timeout = min(timeout, (cost - self._tokens) / self._refill_rate)
+                if now >= deadline:
+                    # Waiters hold the server's shared worker threads, so give up rather than queue without bound;
+                    # the ticket is released so the callers behind it are not stuck waiting on it
+                    if ticket == self._rate_serving:
+                        self._advance_rate_queue()
+                    else:
+                        self._rate_abandoned.add(ticket)
+                    logger.warning("Rate limit wait timed out; rejecting call")
+                    return False
+                if not delayed:
+                    logger.info("Rate limit active. Waiting for a token")
+                    delayed = True
+                # Releases the lock while waiting, so other callers and valve updates are not blocked behind a sleeper
+                self._rate_cond.wait(timeout)
+
+    def _refund(self, cost: float = 1.0):
+        """Returns tokens taken by a call that was rejected before it reached Flowise."""
+        with self._rate_cond:
+            self._tokens = min(self._capacity, self._tokens + cost)
+            self._rate_cond.notify_all()
 
     def parse_user_input(self, user_message: str) -> str:
-        date_now = datetime.now().strftime("%Y-%m-%d")
-        time_now = datetime.now().strftime("%H:%M:%S")
         query = f"{user_message.strip()}"
         logger.info(f"Parsed user input: {query}")
         return query
 
     def safe_get(self, d, *keys):
         """Safely gets a nested value from a dictionary, returning None if any key in the path is missing or not a dictionary."""
-        current = d
-        for key in keys:
-            if not isinstance(current, dict):
-                return None
-            current = current.get(key)
-            if current is None:
-                return None
-        return current
+        # The path is usually present, so one try beats a type check and lookup per level;
+        # dict.__getitem__ raises TypeError on a non-dict (None included) along the way
+        try:
+            return reduce(dict.__getitem__, keys, d)
+        except (KeyError, TypeError):
+            return None
     
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
         logger.info(f"Pipeline triggered for message: {user_message}")
@@ -132,15 +459,20 @@ class Pipeline:
         # This block ensures 'body' is always a dictionary before any dictionary methods like .get() are called on it.
         if isinstance(body, str):
             try:
-                body = json.loads(body)
+                body = _loads(body)
             except json.JSONDecodeError:
                 error_msg = "Error: The 'body' parameter received was an invalid JSON string. It must be a valid JSON object or a dictionary."
                 logger.error(error_msg)
                 return error_msg
 
-        # Get starting time for total analysis time at the end of an LLM turn
-        dt_start = datetime.now()
         streaming = body.get("stream", False)
+
+        # Reject empty input before any extraction, rate limiting or network work; the message is stripped only here
+        query = self.parse_user_input(user_message) if user_message else ""
+        if not query:
+            error_msg = "Query is empty."
+            return error_msg if not streaming else _stream_message(error_msg)
+
         session_id = self.chat_id
 
         system_message = None
@@ -159,27 +491,27 @@ class Pipeline:
 
         logger.debug(f"Extracted system_message: {system_message}")
 
-        if not self.valves.FLOWISE_API_KEY or not self.valves.FLOWISE_BASE_URL:
+        if not self._has_connection:
             error_msg = "Missing FlowiseAI configuration."
             logger.error(error_msg)
-            return error_msg if not streaming else iter([error_msg])
+            return error_msg if not streaming else _stream_message(error_msg)
 
-        query = self.parse_user_input(user_message)
-
-        if not self.valves.FLOW_ENABLED or not self.flow_id:
+        if not self._flow_enabled or not self.flow_id:
             error_msg = "FlowiseAI flow is not configured or enabled."
             logger.warning(error_msg)
-            return error_msg if not streaming else iter([error_msg])
+            return error_msg if not streaming else _stream_message(error_msg)
 
         if streaming:
-            return self.stream_retrieve(self.flow_id, self.flow_name, query, dt_start, session_id, system_message)
+            return self.stream_retrieve(self.flow_id, self.flow_name, query, session_id, system_message)
         else:
-            return self.static_retrieve(self.flow_id, self.flow_name, query, dt_start, session_id, system_message)
+            return self.static_retrieve(self.flow_id, self.flow_name, query, session_id, system_message)
 
     async def inlet(self, body: dict, user: Optional[dict] = None) -> dict:
         logger.info(f"inlet: {__name__}")
-        logger.debug(f"body: {json.dumps(body, indent=2)}")
-        logger.debug(f"user: {json.dumps(user, indent=2)}")
+        # Pretty-printing the whole request is only worth paying for when debug output is actually emitted
+        if logger.isEnabledFor(DEBUG):
+            logger.debug("body: %s", _dumps_pretty(body))
+            logger.debug("user: %s", _dumps_pretty(user))
         
         self.user_id = user.get("id") if user else None
         self.user_name = user.get("name") if user else None
@@ -193,23 +525,19 @@ class Pipeline:
         logger.debug(f"Extracted message_id: {self.message_id}")
 
         return body
-    
-    import json
 
     def unwrap_json(self, value):
-        import json
-
         def try_parse_json(val):
-            if isinstance(val, str):
-                val = val.strip()
-                if (val.startswith('{') and val.endswith('}')) or (val.startswith('[') and val.endswith(']')):
-                    try:
-                        return json.loads(val)
-                    except json.JSONDecodeError:
-                        pass
-            return val
+            if type(val) is not str or not _looks_jsonish(val):
+                return val
+            try:
+                return _loads(val)
+            except json.JSONDecodeError:
+                return val
 
         def recurse(val):
+            if not isinstance(val, (str, dict, list)):
+                return val
             val = try_parse_json(val)
 
             if isinstance(val, dict):
@@ -221,37 +549,218 @@ class Pipeline:
 
         return recurse(value)
 
-    def stream_retrieve(self, flow_id: str, flow_name: str, query: str, dt_start: datetime, session_id: Optional[str], system_message: Optional[str]) -> Generator:
+    def _build_event_handlers(self):
+        """Binds one handler per stream event name, resolving the display valves once per valve change instead of per chunk."""
+        v = self.valves
+        # Display flags read inside the handlers; each stream copies them onto its _StreamState
+        flags = (v.DISPLAY_AGENT_REASONING, v.DISPLAY_CALLED_TOOLS, v.DISPLAY_CALLED_TOOLS_INPUT, v.DISPLAY_CALLED_TOOLS_OUTPUT)
+        skip = self._h_skip
+        other = self._h_other
+        handlers = {
+            "token": self._h_token,
+            "start": self._h_start if v.DISPLAY_START_EVENT else skip,
+            "update": self._h_update if v.DISPLAY_UPDATE_EVENT else skip,
+            "agentReasoning": self._h_agent_reasoning,
+            "metadata": self._h_metadata if v.DISPLAY_METADATA else skip,
+            # Handle specific "Other Event" types based on the user's example
+            "agentFlowEvent": other if v.DISPLAY_AGENT_FLOW_EVENT else skip,
+            "nextAgentFlow": other if v.DISPLAY_NEXT_AGENT_FLOW else skip,
+            "agentFlowExecutedData": other if v.DISPLAY_AGENT_FLOW_EXECUTED_DATA else skip,
+            "usedTools": self._h_used_tools,
+            "usageMetadata": other if v.DISPLAY_USAGE_METADATA else skip,
+            "end": self._h_end if v.DISPLAY_END_EVENT else skip,
+            "agent_trace": self._h_agent_trace,
+        }
+        fallback = other if v.DISPLAY_OTHER_EVENTS else skip
+        # Published as one tuple, so a stream picks up the table and the flags from the same valve state
+        self._event_dispatch = (handlers, fallback, flags)
+
+    # Stream event handlers: each takes the per-call state plus the chunk's event and data,
+    # and returns a sequence of items to yield, or None for nothing.
+
+    def _h_skip(self, state, event, data):
+        return None
+
+    def _h_token(self, state, event, data):
+        # Batching keeps generator round trips per yield down on fast streams; a token after a pause still goes out at once.
+        # The interval is only checked as events arrive, so tokens buffered right before an upstream stall wait for the next event.
+        if data is None:
+            return None
+        state.token_buf.append(data if type(data) is str else str(data))
+        if len(state.token_buf) >= TOKEN_BATCH_SIZE or time.monotonic() - state.last_flush > TOKEN_BATCH_INTERVAL:
+            return (state.flush_tokens(),)
+        return None
+
+    def _h_start(self, state, event, data):
+        # Chunks come straight from the JSON decoder, so exact type checks are safe and skip the MRO walk
+        t = type(data)
+        if t is str:
+            return (f"_Analysis started... {state.start_stamp}:_\n{data}\n",)
+        if t is dict or t is list:
+            return (f"__Start Data__:\n```json\n{_dumps_pretty(data)}\n```",)
+        return (f"[Start] Unexpected data format: {str(data)}\n",)
+
+    def _h_update(self, state, event, data):
+        return (f"[Update] {_dumps(data)}\n",)
+
+    def _h_agent_reasoning(self, state, event, data):
+        out = [_STATUS_THINKING]
+        if state.show_reasoning:
+            if type(data) is list:
+                if not data:
+                    return out
+                # One yield for all steps; the status dict ahead of it stays separate so the UI still sees it
+                out.append("".join([f"[Reasoning Step] {_dumps_pretty(step)}\n" for step in data]))
+            else:
+                out.append(f"[Reasoning] {_dumps_pretty(data)}\n")
+        return out
+
+    def _h_metadata(self, state, event, data):
+        return (f"[Metadata] {_dumps_pretty(data)}\n",)
+
+    def _h_other(self, state, event, data):
+        return (_format_other_event(event, data),)
+
+    def _h_used_tools(self, state, event, data):
+        out = [_STATUS_TOOL_CALLING]
+        if not state.show_tools:
+            return out
+        show_input = state.show_tools_input
+        show_output = state.show_tools_output
+        if type(data) is list:
+            formatted_tools = []
+            for tool_call in data:
+                tool_name = tool_call.get("tool", "Unknown Tool")
+                tool_input = tool_call.get("toolInput", {})
+                tool_output = tool_call.get("toolOutput", {})
+                if logger.isEnabledFor(DEBUG):
+                    logger.debug("toolOutput: %s", _dumps_pretty(tool_output))
+
+                # Attempt to parse toolInput if it's a JSON string
+                if show_input and type(tool_input) is str:
+                    try:
+                        tool_input = _loads(tool_input)
+                    except json.JSONDecodeError:
+                        pass # Keep as string if not valid JSON
+
+                # Attempt to parse toolOutput if it's a JSON string
+                # if isinstance(tool_output, str):
+                #     try:
+                #         tool_output = json.loads(tool_output)
+                #     except json.JSONDecodeError:
+                #         pass # Keep as string if not valid JSON
+                if show_output:
+                    tool_output = self.unwrap_json(tool_output)
+
+                formatted_tools.append(f"  - {tool_name}\n")
+                if show_input:
+                    formatted_tools.append(f"```json\nInput:\n\n{_dumps_pretty(tool_input)}\n```\n")
+                if show_output:
+                    formatted_tools.append(f"```json\nOutput:\n\n{_dumps_pretty(tool_output)}\n```")
+            out.append(f"\n\n__Called Tools__:\n" + "\n".join(formatted_tools) + "\n")
+        else:
+            out.append(f"\n\n__Called Tools__:\n```json\n{_dumps_pretty(data)}\n```\n")
+        return out
+
+    def _h_end(self, state, event, data):
+        if state.end_stamp is None:
+            state.end_stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        return (f"Analysis complete... {state.end_stamp}\n",)
+
+    def _h_agent_trace(self, state, event, data):
+        agent_step = data.get("step")
+        if agent_step != "agent_action":
+            return None
+        # Step 1: Parse the "action" field, which is a JSON string
+        action_dict = _loads(data.get("action"))
+
+        # Step 2: Get the tool name
+        tool_name = action_dict.get("tool", "Unknown tool")
+        return ({
+            "event": {
+                "type": "status",
+                "data": {
+                    "description": f"Tool calling {tool_name}...\n",
+                    "done": False
+                }
+            }
+        },)
+
+    def _build_override_config(self, session_id: Optional[str], system_message: Optional[str]) -> Optional[dict]:
+        """overrideConfig shared by streaming and static predictions, or None when there is nothing to override."""
+        override_config = {}
+        if session_id:
+            override_config["sessionId"] = session_id
+        # Add the extracted system message to the overrideConfig for FlowiseAI.
+        # FlowiseAI chatflows can then access this via `req.body.overrideConfig.systemMessage`.
+        # Only include systemMessage if a value is provided, to avoid FlowiseAI errors
+        # when an empty string is passed for a variable expected to be populated.
+        if system_message is not None:
+            override_config["vars"] = {"systemMessageOpenWebUI": system_message}
+        return override_config or None
+
+    def _iter_prediction(self, flow_id: str, payload: dict) -> Generator:
+        """Posts a streaming prediction on the shared session and yields the raw `data:` payload of each SSE event.
+
+        A flow that cannot stream answers with a plain JSON body instead, which is yielded once as a dict.
+        """
+        with self._session.post(self._prediction_url + flow_id, json=payload, stream=True, timeout=PREDICTION_TIMEOUT) as response:
+            response.raise_for_status()
+            if "text/event-stream" not in response.headers.get("Content-Type", ""):
+                yield _loads(response.content)
+                return
+            # chunk_size=None hands over each chunk as it arrives instead of waiting to fill a fixed-size read
+            for line in response.iter_lines(chunk_size=None):
+                # Each Flowise event is a single "data:" line; "message:" markers and blank separators carry nothing
+                if line.startswith(b"data:"):
+                    yield line[5:].strip()
+
+    @contextmanager
+    def _upstream_slot(self):
+        """Holds one MAX_CONCURRENCY slot for the duration of the block. Raises _UpstreamBusy if none frees up in time."""
+        slots = self._upstream_slots
+        if not slots.acquire(timeout=UPSTREAM_SLOT_TIMEOUT):
+            logger.warning("No free FlowiseAI request slot; rejecting call")
+            raise _UpstreamBusy()
+        try:
+            yield
+        finally:
+            slots.release()
+
+    def stream_retrieve(self, flow_id: str, flow_name: str, query: str, session_id: Optional[str], system_message: Optional[str]) -> Generator:
         if not query:
             yield "Query is empty."
             return
 
+        # Rate token first, so callers queued on the limiter do not sit on a concurrency slot
+        if not self._acquire():
+            yield RATE_LIMITED_MESSAGE
+            return
         try:
-            logger.info(f"Streaming query to FlowiseAI: {query}")
-            self.rate_check(dt_start)
+            # The slot is held until the stream is exhausted or the generator is closed
+            with self._upstream_slot():
+                yield from self._stream_prediction(flow_id, query, session_id, system_message)
+        except _UpstreamBusy:
+            # Never reached Flowise, so it should not count against the rate limit
+            self._refund()
+            yield UPSTREAM_BUSY_MESSAGE
+
+    def _stream_prediction(self, flow_id: str, query: str, session_id: Optional[str], system_message: Optional[str]) -> Generator:
+        # Get starting time for total analysis time at the end of an LLM turn; monotonic so clock adjustments cannot skew it
+        t_start = time.monotonic()
+        # Wall-clock time is only needed for display: formatted once and reused by the status line and the start event
+        start_stamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-            client = Flowise(
-                base_url=self.valves.FLOWISE_BASE_URL.rstrip('/'),
-                api_key=self.valves.FLOWISE_API_KEY
-            )
+        try:
+            logger.info(f"Streaming query to FlowiseAI: {query}")
 
-            prediction_data = PredictionData(chatflowId=flow_id, question=query, streaming=True)
-            override_config = {}
-            if session_id:
-                override_config["sessionId"] = session_id
-            # Add the extracted system message to the overrideConfig for FlowiseAI.
-            # FlowiseAI chatflows can then access this via `req.body.overrideConfig.systemMessage`.
-            # Only include systemMessage if a value is provided, to avoid FlowiseAI errors
-            # when an empty string is passed for a variable expected to be populated.
-            if system_message is not None:
-                if "vars" not in override_config:
-                    override_config["vars"] = {}
-                override_config["vars"]["systemMessageOpenWebUI"] = system_message
+            payload = {"question": query, "streaming": True}
+            override_config = self._build_override_config(session_id, system_message)
             if override_config:
-                prediction_data.overrideConfig = override_config
+                payload["overrideConfig"] = override_config
             logger.debug(f"overrideConfig = {override_config}")
 
-            completion = client.create_prediction(prediction_data)
+            completion = self._iter_prediction(flow_id, payload)
         except requests.exceptions.RequestException as e:
             error_msg = f"❌ Network error during streaming:\n```\n{str(e)}\n```"
             logger.error(error_msg)
@@ -268,157 +777,63 @@ class Pipeline:
             "event": {
                 "type": "status",
                 "data": {
-                    "description": f"Analysis started at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n",
+                    "description": f"Analysis started at {start_stamp}\n",
                     "done": False
                 }
             }
         }
 
-        for chunk in completion:
-            logger.debug(f"Raw chunk: {chunk}")
-            try:
-                if isinstance(chunk, str):
+        # Handlers are bound once per valve change; snapshot the table and its display flags so a mid-stream update cannot mix configurations
+        handlers, fallback, flags = self._event_dispatch
+        token_handler = handlers["token"]
+        state = _StreamState(start_stamp, flags)
+
+        try:
+            for chunk in completion:
+                # Lazy %s formatting: with debug off this is a level check, not a string build per chunk
+                logger.debug("Raw chunk: %s", chunk)
+                try:
                     try:
-                        chunk = json.loads(chunk)
+                        event, data, error = _parse_chunk(chunk)
                     except json.JSONDecodeError:
+                        if state.token_buf:
+                            yield state.flush_tokens()
+                        if type(chunk) is bytes:
+                            chunk = chunk.decode("utf-8", "replace")
                         logger.warning(f"Non-JSON chunk: {chunk}")
                         yield f"⚠️ Invalid JSON chunk:\n```\n{chunk}\n```"
                         continue
 
-                # process normal chunk chunk
-                if "error" in chunk:
-                    yield f"🚨 Error during streaming: {chunk['error']}"
-                    continue
-
-                event = chunk.get("event")
-                data = chunk.get("data")
-
-                if event == "token":
-                    yield data
-
-                elif event == "start":
-                    if self.valves.DISPLAY_START_EVENT:
-                        if isinstance(data, str):
-                            yield f"_Analysis started... {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}:_\n{data}\n"
-                        elif isinstance(data, dict) or isinstance(data, list):
-                            yield f"__Start Data__:\n```json\n{json.dumps(data, indent=2)}\n```"
-                        else:
-                            yield f"[Start] Unexpected data format: {str(data)}\n"
-
-                elif event == "update":
-                    if self.valves.DISPLAY_UPDATE_EVENT:
-                        yield f"[Update] {json.dumps(data)}\n"
-
-                elif event == "agentReasoning":
-                    yield {
-                        "event": {
-                            "type": "status",
-                            "data": {
-                                "description": f"Thinking...\n",
-                                "done": False
-                            }
-                        }
-                    }
-                    if self.valves.DISPLAY_AGENT_REASONING:
-                        if isinstance(data, list):
-                            for step in data:
-                                yield f"[Reasoning Step] {json.dumps(step, indent=2)}\n"
-                        else:
-                            yield f"[Reasoning] {json.dumps(data, indent=2)}\n"
-
-                elif event == "metadata":
-                    if self.valves.DISPLAY_METADATA:
-                        yield f"[Metadata] {json.dumps(data, indent=2)}\n"
-
-                elif "error" in chunk:
-                    yield f"Error from FlowiseAI: {chunk['error']}"
-
-                # Handle specific "Other Event" types based on the user's example
-                elif event == "agentFlowEvent":
-                    if self.valves.DISPLAY_AGENT_FLOW_EVENT:
-                        yield f"[Other Event: {event}] {json.dumps(data)}\n"
-                elif event == "nextAgentFlow":
-                    if self.valves.DISPLAY_NEXT_AGENT_FLOW:
-                        yield f"[Other Event: {event}] {json.dumps(data)}\n"
-                elif event == "agentFlowExecutedData":
-                    if self.valves.DISPLAY_AGENT_FLOW_EXECUTED_DATA:
-                        yield f"[Other Event: {event}] {json.dumps(data)}\n"
-                elif event == "usedTools":
-                    yield {
-                        "event": {
-                            "type": "status",
-                            "data": {
-                                "description": f"Tool calling...\n",
-                                "done": False
-                            }
-                        }
-                    }
-                    if self.valves.DISPLAY_CALLED_TOOLS:
-                        formatted_tools = []
-                        if isinstance(data, list):
-                            for tool_call in data:
-                                tool_name = tool_call.get("tool", "Unknown Tool")
-                                tool_input = tool_call.get("toolInput", {})
-                                tool_output = tool_call.get("toolOutput", {})
-                                logger.debug(f"toolOutput: {json.dumps(tool_output, indent=2)}")
-
-                                # Attempt to parse toolInput if it's a JSON string                                
-                                if isinstance(tool_input, str):
-                                    try:
-                                        tool_input = json.loads(tool_input)
-                                    except json.JSONDecodeError:
-                                        pass # Keep as string if not valid JSON
-
-                                # Attempt to parse toolOutput if it's a JSON string
-                                # if isinstance(tool_output, str):
-                                #     try:
-                                #         tool_output = json.loads(tool_output)
-                                #     except json.JSONDecodeError:
-                                #         pass # Keep as string if not valid JSON
-                                tool_output = self.unwrap_json(tool_output)
-
-                                formatted_tools.append(f"  - {tool_name}\n")
-                                if self.valves.DISPLAY_CALLED_TOOLS_INPUT:
-                                    formatted_tools.append(f"```json\nInput:\n\n{json.dumps(tool_input, indent=2)}\n```\n")
-                                if self.valves.DISPLAY_CALLED_TOOLS_OUTPUT:
-                                    formatted_tools.append(f"```json\nOutput:\n\n{json.dumps(tool_output, indent=2)}\n```")
-                            yield f"\n\n__Called Tools__:\n" + "\n".join(formatted_tools) + "\n"
-                        else:
-                            yield f"\n\n__Called Tools__:\n```json\n{json.dumps(data, indent=2)}\n```\n"
-                elif event == "usageMetadata":
-                    if self.valves.DISPLAY_USAGE_METADATA:
-                        yield f"[Other Event: {event}] {json.dumps(data)}\n"
-                elif event == "end":
-                    if self.valves.DISPLAY_END_EVENT:
-                        yield f"Analysis complete... {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n"
-                elif event == "agent_trace":
-                    agent_step = data.get("step")
-                    if agent_step == "agent_action":
-                        # Step 1: Parse the "action" field, which is a JSON string
-                        action_str = data.get("action")
-                        action_dict = json.loads(action_str)
-
-                        # Step 2: Get the tool name
-                        tool_name = action_dict.get("tool", "Unknown tool")
-                        yield {
-                            "event": {
-                                "type": "status",
-                                "data": {
-                                    "description": f"Tool calling {tool_name}...\n",
-                                    "done": False
-                                }
-                            }
-                        }
-                else:
-                    if self.valves.DISPLAY_OTHER_EVENTS:
-                        yield f"[Other Event: {event}] {json.dumps(data)}\n"
-
-            except Exception as e:
-                logger.exception("Error processing stream chunk")
-                yield f"\nError handling chunk: {str(e)}"
+                    handler = handlers.get(event, fallback) if error is _NO_ERROR else None
+                    # Anything other than a token must not overtake tokens still waiting in the batch
+                    if state.token_buf and handler is not token_handler:
+                        yield state.flush_tokens()
+
+                    # process normal chunk chunk
+                    if error is not _NO_ERROR:
+                        yield f"🚨 Error during streaming: {error}"
+                        continue
+
+                    out = handler(state, event, data)
+                    if out:
+                        yield from out
+
+                except Exception as e:
+                    logger.exception("Error processing stream chunk")
+                    yield f"\nError handling chunk: {str(e)}"
+        except requests.exceptions.RequestException as e:
+            # The prediction is posted and read lazily, so HTTP errors, connection drops and timeouts all surface here
+            if state.token_buf:
+                yield state.flush_tokens()
+            error_msg = f"❌ Network error during streaming:\n```\n{str(e)}\n```"
+            logger.error(error_msg)
+            yield error_msg
+
+        if state.token_buf:
+            yield state.flush_tokens()
 
+        total_analysis_time = time.monotonic() - t_start
         dt_end = datetime.now()
-        total_analysis_time = (dt_end - dt_start).total_seconds()
         # Update status line
         yield {
             "event": {
@@ -430,49 +845,54 @@ class Pipeline:
             }
         }
 
-    def static_retrieve(self, flow_id: str, flow_name: str, query: str, dt_start: datetime, session_id: Optional[str], system_message: Optional[str]) -> Generator:
+    def static_retrieve(self, flow_id: str, flow_name: str, query: str, session_id: Optional[str], system_message: Optional[str]) -> str:
         if not query:
-            yield "Query is empty."
-            return
+            return "Query is empty."
 
-        api_url = f"{self.valves.FLOWISE_BASE_URL.rstrip('/')}/api/v1/prediction/{flow_id}"
-        headers = {"Authorization": f"Bearer {self.valves.FLOWISE_API_KEY}"}
+        api_url = self._prediction_url + flow_id
         payload = {"question": query}
-        override_config = {}
-        if session_id:
-            override_config["sessionId"] = session_id
-        # Add the extracted system message to the overrideConfig for FlowiseAI.
-        # FlowiseAI chatflows can then access this via `req.body.overrideConfig.systemMessage`.
-        # Only include systemMessage if a value is provided, to avoid FlowiseAI errors
-        # when an empty string is passed for a variable expected to be populated.
-        if system_message is not None:
-            if "vars" not in override_config:
-                override_config["vars"] = {}
-            override_config["vars"]["systemMessageOpenWebUI"] = system_message
+        override_config = self._build_override_config(session_id, system_message)
         if override_config:
             payload["overrideConfig"] = override_config
 
         try:
             logger.info(f"Sending static query to FlowiseAI: {query}")
-            self.rate_check(dt_start)
-            response = requests.post(api_url, headers=headers, json=payload)
-
-            if response.status_code != 200:
-                yield f"Error from FlowiseAI: Status {response.status_code}"
-                return
-
-            result = response.json()
+            if not self._acquire():
+                return RATE_LIMITED_MESSAGE
+            # Not streamed: the body is read in full, so the connection goes back to the pool for reuse
+            with self._upstream_slot(), self._session.post(api_url, json=payload, timeout=PREDICTION_TIMEOUT) as response:
+                if response.status_code != 200:
+                    return f"Error from FlowiseAI: Status {response.status_code}"
+
+                content_type = response.headers.get("Content-Type", "")
+                if "text/plain" in content_type:
+                    # A plain-text answer is returned as is, without a JSON parse attempt that can only fail
+                    return response.text
+                # Parse straight from the raw bytes rather than decoding to text first; fall back to the text body if it is not JSON
+                try:
+                    result = _loads(response.content)
+                except ValueError:
+                    result = response.text
             logger.info("Received static response from FlowiseAI")
 
             if isinstance(result, dict):
-                for key in ["text", "answer", "response", "result"]:
-                    if key in result:
-                        yield result[key]
-                        return
-                yield f"```json\n{json.dumps(result, indent=2)}\n```"
+                answer = next((result[k] for k in self._STATIC_KEYS if k in result), None)
+                if answer is not None:
+                    return answer
+                return f"```json\n{_dumps_pretty(result)}\n```"
             elif isinstance(result, str):
-                yield result
+                return result
             else:
-                yield f"```json\n{json.dumps(result, indent=2)}\n```"
+                return f"```json\n{_dumps_pretty(result)}\n```"
+        except _UpstreamBusy:
+            # Never reached Flowise, so it should not count against the rate limit
+            self._refund()
+            return UPSTREAM_BUSY_MESSAGE
         except Exception as e:
-            yield f"Error calling FlowiseAI: {str(e)}"
+            return f"Error calling FlowiseAI: {str(e)}"
+
+
+# Valve defaults overridden from the environment, validated (and coerced, e.g. "false" -> False) once at import
+_ENV_VALVES = Pipeline.Valves(
+    **{k: os.getenv(k, v.default) for k, v in Pipeline.Valves.model_fields.items()}
+).model_dump()